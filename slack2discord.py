@@ -1,16 +1,36 @@
 #!/usr/bin/env python3
 # Author: Rocky Slavin
 # Slack message history importer for Discord
-import json
+import asyncio
 import os
+import re
 import time
-from datetime import datetime
+from functools import lru_cache
+from itertools import islice
 from discord.ext import commands
 import discord
 import io
+import logging
 import aiohttp
+import ijson
+import orjson
 
 THROTTLE_TIME_SECONDS = 0.1
+LOG_LEVEL = logging.INFO
+METADATA_CACHE_SIZE = 32
+TIMESTAMP_FORMAT = '%m/%d/%Y at %H:%M:%S'
+TIMESTAMP_CACHE_SIZE = 4096
+MAX_SEND_ATTEMPTS = 5
+MENTION_PATTERN = re.compile(r'<[@#][A-Z0-9]+>')
+MAX_CONNECTIONS_PER_HOST = 8
+SEND_QUEUE_SIZE = 16
+PARSE_BATCH_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+# shared across all file downloads so connections to Slack are kept alive and reused
+http_session = None
+download_semaphore = asyncio.Semaphore(MAX_CONNECTIONS_PER_HOST)
 
 
 def get_file_paths(file_path):
@@ -23,131 +43,406 @@ def get_file_paths(file_path):
 
     # if directory, load files
     if os.path.isdir(file_path):
-        json_files = [os.path.join(file_path, f) for f in os.listdir(
-            file_path) if f.endswith('.json')]
+        with os.scandir(file_path) as entries:
+            json_files = [entry.path for entry in entries if entry.name.endswith(
+                '.json') and entry.is_file()]
     elif file_path.endswith('.json'):
         json_files.append(file_path)
 
     if not json_files:
-        print(f'[ERROR] No .json files found at {file_path}')
+        logger.error('No .json files found at %s', file_path)
     else:
-        print(f'[INFO] {len(json_files)} .json files loaded')
+        logger.info('%d .json files loaded', len(json_files))
 
     return json_files
 
 
-def get_display_names(json_file_paths):
+@lru_cache(maxsize=METADATA_CACHE_SIZE)
+def load_display_names(file_path, mtime):
     """
-    Generates a dictionary of user_id => display_name pairs
+    Parses users.json into a dictionary of user_id => display_name pairs. Results are cached per path and
+    modification time so repeated imports from the same export don't re-parse the file. The returned dictionary is
+    shared between callers and must not be modified.
+    :param file_path: Path to users.json
+    :param mtime: Modification time of the file, used as part of the cache key
+    :return: Dictionary of user_id => display_name pairs
+    """
+    with open(file_path, 'rb') as f:
+        users_json = orjson.loads(f.read())
+    return {user['id']: user['profile'].get('display_name') or user['profile'].get('real_name')
+            for user in users_json}
+
+
+@lru_cache(maxsize=METADATA_CACHE_SIZE)
+def load_channel_names(file_path, mtime):
+    """
+    Parses channels.json into a dictionary of channel_id => channel_name pairs. Cached the same way as
+    load_display_names.
+    :param file_path: Path to channels.json
+    :param mtime: Modification time of the file, used as part of the cache key
+    :return: Dictionary of channel_id => channel_name pairs
+    """
+    with open(file_path, 'rb') as f:
+        channels_json = orjson.loads(f.read())
+    return {channel['id']: channel['name'] for channel in channels_json}
+
+
+def locate_metadata(json_file_paths):
+    """
+    Locates users.json and channels.json for the files being imported. Each is looked for in the directory of the
+    files and then in its parent (the export root when a channel directory is imported).
     :param json_file_paths: List of paths being parsed
-    :return: Dictionary or None if no file is found
+    :return: Tuple of (users.json path, channels.json path), each None if not found
     """
-    users = {}
+    file_dir = os.path.dirname(json_file_paths[0])
+    search_dirs = (file_dir, os.path.dirname(file_dir))
+
+    def locate(file_name):
+        logger.info('Attempting to locate %s', file_name)
+        for search_dir in search_dirs:
+            file_path = os.path.join(search_dir, file_name)
+            if os.path.isfile(file_path):
+                return file_path
+        logger.error('Unable to locate %s', file_name)
+        return None
 
-    print(f'[INFO] Attempting to locate users.json')
+    return locate('users.json'), locate('channels.json')
 
-    user_file_path_dir = os.path.join(
-        os.path.dirname(json_file_paths[0]), 'users.json')
-    user_file_path_files = os.path.join(os.path.dirname(
-        os.path.dirname(json_file_paths[0])), 'users.json')
 
-    if os.path.isfile(user_file_path_dir):
-        file_path = user_file_path_dir
-    elif os.path.isfile(user_file_path_files):
-        file_path = user_file_path_files
-    else:
-        print(f'[ERROR] Unable to locate users.json')
+def get_display_names(file_path):
+    """
+    Generates a dictionary of user_id => display_name pairs
+    :param file_path: Path to users.json as returned by locate_metadata
+    :return: Dictionary or None if no file is found
+    """
+    if file_path is None:
         return None
 
     try:
-        with open(file_path, encoding='utf-8') as f:
-            users_json = json.load(f)
-            for user in users_json:
-                users[user['id']] = (
-                    user['profile']['display_name'] if user['profile']['display_name'] else user['profile'][
-                        'real_name'])
-                print(
-                    f"\tUser ID: {user['id']} -> Display Name: {users[user['id']]}")
+        users = load_display_names(file_path, os.path.getmtime(file_path))
     except Exception as e:
-        print(f'[ERROR] Unable to load display names: {e}')
+        logger.error('Unable to load display names: %s', e)
         return None
+
+    if logger.isEnabledFor(logging.DEBUG):
+        for uid, name in users.items():
+            logger.debug('\tUser ID: %s -> Display Name: %s', uid, name)
+    logger.info('%d display names loaded', len(users))
     return users
 
 
-def get_channel_names(json_file_paths):
+def get_channel_names(file_path):
     """
     Generates a dictionary of channel_id => channel_name pairs
-    :param json_file_paths: List of paths being parsed
+    :param file_path: Path to channels.json as returned by locate_metadata
     :return: Dictionary or None if no file is found
     """
-    channels = {}
-
-    print(f'[INFO] Attempting to locate channels.json')
-
-    channel_file_path_dir = os.path.join(
-        os.path.dirname(json_file_paths[0]), 'channels.json')
-    channel_file_path_files = os.path.join(os.path.dirname(
-        os.path.dirname(json_file_paths[0])), 'channels.json')
-
-    if os.path.isfile(channel_file_path_dir):
-        file_path = channel_file_path_dir
-    elif os.path.isfile(channel_file_path_files):
-        file_path = channel_file_path_files
-    else:
-        print(f'[ERROR] Unable to locate channels.json')
+    if file_path is None:
         return None
 
     try:
-        with open(file_path, encoding='utf-8') as f:
-            channels_json = json.load(f)
-            for channel in channels_json:
-                channels[channel['id']] = channel['name']
-                print(
-                    f"\tChannel ID: {channel['id']} -> Channel Name: {channels[channel['id']]}")
+        channels = load_channel_names(file_path, os.path.getmtime(file_path))
     except Exception as e:
-        print(f'[ERROR] Unable to load channel names: {e}')
+        logger.error('Unable to load channel names: %s', e)
         return None
+
+    if logger.isEnabledFor(logging.DEBUG):
+        for cid, name in channels.items():
+            logger.debug('\tChannel ID: %s -> Channel Name: %s', cid, name)
+    logger.info('%d channel names loaded', len(channels))
     return channels
 
 
-def fill_references(message, users, channels, files):
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def format_timestamp(seconds):
+    """
+    Formats a Slack timestamp for display. Only whole seconds are shown, so bursts of messages sent within the same
+    second share a cached result.
+    :param seconds: Whole seconds of the Slack ts value
+    :return: Formatted date and time string
+    """
+    return time.strftime(TIMESTAMP_FORMAT, time.localtime(seconds))
+
+
+def get_reference_table(users, channels):
+    """
+    Generates a dictionary of raw Slack reference tokens to their filled form, e.g. <@U123> => @name and
+    <#C123> => #channel
+    :param users: Dictionary of user_id => display_name pairs (or None)
+    :param channels: Dictionary of channel_id => channel_name pairs (or None)
+    :return: Dictionary of token => replacement pairs
+    """
+    references = {f'<@{uid}>': f'@{name}' for uid, name in (users or {}).items()}
+    references.update({f'<#{cid}>': f'#{name}' for cid, name in (channels or {}).items()})
+    return references
+
+
+def fill_references(message, references, files):
     """
     Fills in @mentions and #channels with their known display names
     :param message: Raw message to be filled with usernames and channel names instead of IDs
-    :param users: Dictionary of user_id => display_name pairs
-    :param channels: Dictionary of channel_id => channel_name pairs
+    :param references: Dictionary of token => replacement pairs from get_reference_table
+    :param files: List of attachment URLs to append to the message
     :return: Filled message string
     """
     MAX_MESSAGE_SIZE = 2000 - 60
-    for uid, name in users.items():
-        message = message.replace(f'<@{uid}>', f'@{name}')
-    for cid, name in channels.items():
-        message = message.replace(f'<#{cid}>', f'#{name}')
 
-    files_msg = ''
-    for file_url in files:
-        files_msg = '\n'.join([files_msg, file_url])
+    # most messages contain no references at all, so skip the regex unless a token could be present
+    if '<@' in message or '<#' in message:
+        message = MENTION_PATTERN.sub(
+            lambda match: references.get(match.group(0), match.group(0)), message)
+
+    message = message.strip('\n')
+    if not files:
+        return message[:MAX_MESSAGE_SIZE]
+
+    files_msg = '\n'.join(files)
+    message = message[:MAX_MESSAGE_SIZE - len(files_msg)]
+    return f'{message}\n{files_msg}' if message else files_msg
 
-    limit = MAX_MESSAGE_SIZE - len(files_msg)
 
-    message = '\n'.join([message[:limit], files_msg]).strip('\n')
-    return message
+def format_message(message, users, references):
+    """
+    Formats a Slack message for Discord as the author, timestamp and filled text
+    :param message: Slack message dictionary
+    :param users: Dictionary of user_id => display_name pairs
+    :param references: Dictionary of token => replacement pairs from get_reference_table
+    :return: Formatted message string or None if user information, timestamp, or text is missing
+    """
+    ts = message.get('ts')
+    text = message.get('text')
+    user_profile = message.get('user_profile')
+    user = message.get('user')
+    if ts is None or text is None or (user_profile is None and user is None):
+        return None
 
+    if user_profile is not None:
+        username = user_profile['display_name'] or user_profile['real_name']
+    else:
+        username = users[user]
+    timestamp = format_timestamp(int(float(ts)))
+    files = [f.get('url_private') for f in message.get('files', [])]
+    text = fill_references(text, references, files)
+    return f'**{username}** *({timestamp})*\n{text}'
 
-async def uploadd_file(channel, file_info):
+
+def get_http_session():
+    """
+    Returns the shared HTTP session, creating it on first use. Commands can be handled before on_ready fires, so the
+    session can't be created there.
+    :return: aiohttp.ClientSession
+    """
+    global http_session
+    if http_session is None:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=MAX_CONNECTIONS_PER_HOST))
+    return http_session
+
+
+async def download_file(file_info):
+    """
+    Downloads a non-image attachment from Slack. The number of simultaneous downloads is bounded by
+    download_semaphore.
+    :param file_info: Slack file object from the message
+    :return: discord.File, False if Slack refused the download, or None if the file is skipped
+    """
     if 'image' in file_info['mimetype']:
-        return
+        return None
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(file_info['url_private']) as resp:
+        async with download_semaphore:
+            async with get_http_session().get(file_info['url_private']) as resp:
                 if resp.status != 200:
-                    return await channel.send('Could not download file...')
+                    return False
                 data = io.BytesIO(await resp.read())
-                await channel.send(file=discord.File(data, file_info['name']))
+                return discord.File(data, file_info['name'])
     except Exception as e:
-        print(
-            f"[INFO] skip dowloading file ({e}) url: {file_info['url_private']}")
-        pass
+        logger.info('skip dowloading file (%s) url: %s', e, file_info['url_private'])
+        return None
+
+
+async def download_files(files_info):
+    """
+    Downloads all attachments of a message concurrently.
+    :param files_info: List of Slack file objects from the message
+    :return: List of download_file results in the same order as files_info
+    """
+    return await asyncio.gather(*[download_file(file_info) for file_info in files_info])
+
+
+async def upload_files(channel, files_info, downloads):
+    """
+    Uploads downloaded attachments to the channel in their original order.
+    :param channel: Discord channel to upload to
+    :param files_info: List of Slack file objects from the message
+    :param downloads: Results of download_files for files_info
+    """
+    for file_info, file in zip(files_info, downloads):
+        try:
+            if file is False:
+                await send_message(channel, 'Could not download file...')
+            elif file is not None:
+                await send_message(channel, file=file)
+        except ImportAborted:
+            raise
+        except Exception as e:
+            logger.info('skip uploading file (%s) url: %s', e, file_info['url_private'])
+
+
+class ImportAborted(Exception):
+    """
+    Raised when Discord keeps refusing to accept messages, so continuing the import would only lose them.
+    """
+
+
+async def send_message(destination, content=None, file=None):
+    """
+    Sends a message or file. discord.py already waits out rate limits itself, so a 429 only reaches this point once
+    its retries are used up, in which case the wait given by Retry-After is honoured before trying again. A 429 without
+    a Via header is a Cloudflare ban rather than an API rate limit and aborts the import.
+    :param destination: Context or channel to send to
+    :param content: Message string to send
+    :param file: discord.File to upload
+    :return: The sent discord.Message
+    """
+    for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+        try:
+            return await destination.send(content, file=file)
+        except discord.HTTPException as e:
+            if e.status != 429:
+                raise
+            headers = e.response.headers
+            if 'Via' not in headers:
+                raise ImportAborted('Temporarily banned from the Discord API by Cloudflare') from e
+            if attempt == MAX_SEND_ATTEMPTS:
+                raise ImportAborted(f'Still rate limited after {MAX_SEND_ATTEMPTS} attempts') from e
+            retry_after = float(headers.get('Retry-After', THROTTLE_TIME_SECONDS))
+            logger.warning('Rate limited, retrying in %ss', retry_after)
+            await asyncio.sleep(retry_after)
+            if file is not None:
+                file.reset()
+
+
+async def send_worker(ctx, queue):
+    """
+    Sends queued messages and their attachments to the channel until a None sentinel is received, or returns early if
+    the import is aborted. A single worker is used so that messages keep their original order, while parsing and
+    attachment downloads for the following messages continue in the background.
+    :param ctx: Context of the channel to send to
+    :param queue: asyncio.Queue of (msg, files_info, downloads) tuples, where downloads is a download_files task
+    """
+    while True:
+        item = await queue.get()
+        try:
+            if item is None:
+                return
+            msg, files_info, downloads = item
+            try:
+                await send_message(ctx, msg)
+                await upload_files(ctx.message.channel, files_info, await downloads)
+                logger.debug("Imported message: '%s'", msg)
+            except ImportAborted as e:
+                logger.error('Import aborted: %s', e)
+                return
+            except Exception as e:
+                logger.error('%s', e)
+        finally:
+            queue.task_done()
+
+
+def read_batch(messages):
+    """
+    Reads the next batch of messages from an ijson iterator.
+    :param messages: Iterator returned by ijson.items
+    :return: List of up to PARSE_BATCH_SIZE messages, empty once the file is exhausted
+    """
+    return list(islice(messages, PARSE_BATCH_SIZE))
+
+
+async def iter_messages(json_file):
+    """
+    Streams the messages of a channel .json file. Parsing runs in a worker thread one batch ahead of the caller, so
+    the next batch is decoded while the current one is being formatted and sent.
+    :param json_file: Path to the channel .json file
+    :return: Async iterator over message dictionaries
+    """
+    with open(json_file, 'rb') as f:
+        messages = ijson.items(f, 'item')
+        pending = asyncio.create_task(asyncio.to_thread(read_batch, messages))
+        try:
+            while True:
+                batch = await pending
+                if not batch:
+                    return
+                pending = asyncio.create_task(asyncio.to_thread(read_batch, messages))
+                for message in batch:
+                    yield message
+        finally:
+            # the file has to stay open until the worker thread is done reading from it, and a parse error in a batch
+            # that will never be consumed must still be retrieved
+            await asyncio.gather(pending, return_exceptions=True)
+
+
+async def import_paths(ctx, paths, queue):
+    """
+    Parses the given paths and queues their messages for send_worker.
+    :param ctx:
+    :param paths: List of paths to import in order
+    :param queue: asyncio.Queue consumed by send_worker
+    :return:
+    """
+    for path in paths:
+        logger.info("Attempting to import '%s' to channel '#%s'", path, ctx.message.channel.name)
+        json_file_paths = get_file_paths(path)
+
+        if not json_file_paths:
+            logger.error('No .json files found at %s', path)
+        else:
+            users_path, channels_path = locate_metadata(json_file_paths)
+
+            users = get_display_names(users_path)
+            if users:
+                logger.info('users.json found - attempting to fill @mentions')
+            else:
+                logger.warning(
+                    'No users.json found - @mentions will contain user IDs instead of display names')
+
+            channels = get_channel_names(channels_path)
+            if channels:
+                logger.info('channels.json found - attempting to fill #channel references')
+            else:
+                logger.warning(
+                    'No channels.json found - #channel references will contain user IDs instead of names')
+
+            references = get_reference_table(users, channels)
+
+            for json_file in sorted(json_file_paths, key=os.path.basename):
+                logger.info('Parsing file: %s', json_file)
+                try:
+                    async for message in iter_messages(json_file):
+                        msg = format_message(message, users, references)
+                        if msg is None:
+                            logger.warning('User information, timestamp, or message text missing')
+                            continue
+
+                        files_info = message.get('files', [])
+                        downloads = asyncio.create_task(download_files(files_info))
+                        await queue.put((msg, files_info, downloads))
+                except Exception as e:
+                    logger.error('%s', e)
+            await queue.join()
+            logger.info('Import complete')
+
+
+class ImportBot(commands.Bot):
+    async def close(self):
+        """
+        Closes the shared HTTP session before shutting down the bot.
+        """
+        global http_session
+        if http_session is not None:
+            await http_session.close()
+            http_session = None
+        await super().close()
 
 
 def register_commands():
@@ -162,64 +457,26 @@ def register_commands():
         :return:
         """
         paths = list(kwpath)
-        for path in paths:
-            print(
-                f"[INFO] Attempting to import '{path}' to channel '#{ctx.message.channel.name}'")
-            json_file_paths = get_file_paths(path)
-
-            if not json_file_paths:
-                print(f'[ERROR] No .json files found at {path}')
-            else:
-                users = get_display_names(json_file_paths)
-                if users:
-                    print(f'[INFO] users.json found - attempting to fill @mentions')
-                else:
-                    print(
-                        f'[WARNING] No users.json found - @mentions will contain user IDs instead of display names')
-
-                channels = get_channel_names(json_file_paths)
-                if channels:
-                    print(
-                        f'[INFO] channels.json found - attempting to fill #channel references')
-                else:
-                    print(
-                        f'[WARNING] No channels.json found - #channel references will contain user IDs instead of names')
-
-                for json_file in sorted(json_file_paths):
-                    print(f'[INFO] Parsing file: {json_file}')
-                    try:
-                        with open(json_file, encoding='utf-8') as f:
-                            for message in json.load(f):
-                                if all(key in message for key in ['ts', 'text']) and any(k in message for k in ['user_profile', 'user']):
-                                    if 'user_profile' in message:
-                                        if message['user_profile']['display_name']:
-                                            username = message['user_profile']['display_name']
-                                        else:
-                                            username = message['user_profile']['real_name']
-                                    else:
-                                        username = users[message['user']]
-                                    timestamp = datetime.fromtimestamp(float(message['ts'])).strftime(
-                                        '%m/%d/%Y at %H:%M:%S')
-                                    files = [f.get('url_private')
-                                             for f in message.get('files', [])]
-                                    text = fill_references(
-                                        message['text'], users, channels, files)
-                                    msg = f'**{username}** *({timestamp})*\n{text}'
-                                    await ctx.send(msg)
-                                    channel = ctx.message.channel
-                                    for file_info in message.get('files', []):
-                                        await uploadd_file(channel, file_info)
-                                    print(f"[INFO] Imported message: '{msg}'")
-                                    time.sleep(THROTTLE_TIME_SECONDS)
-                                else:
-                                    print(
-                                        '[WARNING] User information, timestamp, or message text missing')
-                    except Exception as e:
-                        print(f'[ERROR] {e}')
-                print(f'[INFO] Import complete')
+        queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        producer = asyncio.create_task(import_paths(ctx, paths, queue))
+        worker = asyncio.create_task(send_worker(ctx, queue))
+        await asyncio.wait({producer, worker}, return_when=asyncio.FIRST_COMPLETED)
+
+        if not worker.done():
+            await queue.put(None)
+            await worker
+            producer.result()
+        else:
+            # the worker only stops before the sentinel if the import was aborted
+            producer.cancel()
+            while not queue.empty():
+                _, _, downloads = queue.get_nowait()
+                downloads.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
 
 
 if __name__ == '__main__':
-    bot = commands.Bot(command_prefix='!')
+    logging.basicConfig(level=LOG_LEVEL, format='[%(levelname)s] %(message)s')
+    bot = ImportBot(command_prefix='!')
     register_commands()
     bot.run(input('Bot token: '))